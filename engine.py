@@ -1,41 +1,190 @@
 import datetime
+import functools
+import json
 import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from docker import Client
+from docker.transport import UnixAdapter
+from docker.transport.unixconn import UnixHTTPConnectionPool
 from requests.exceptions import ReadTimeout
 from tornado import gen
 from tornado.httpclient import HTTPError
 from tornado.ioloop import IOLoop
+from tornado.locks import Lock, Semaphore
 from tornado.queues import Queue
 
 from stand import Stand
 
 log = logging.getLogger(__name__)
 
+DOCKER_SOCKET = '/var/run/docker.sock'
+DOCKER_URL = 'unix://' + DOCKER_SOCKET
+DOCKER_WORKERS = 8
+
+
+class UnixConnectionPool(UnixHTTPConnectionPool):
+    """
+    UnixHTTPConnectionPool из docker-py 1.10 держит одно соединение: при одновременных запросах из пула потоков
+    остальные соединения с docker.sock открываются заново и закрываются после ответа
+    """
+
+    def __init__(self, base_url, socket_path, timeout=60, maxsize=1):
+        super(UnixHTTPConnectionPool, self).__init__('localhost', timeout=timeout, maxsize=maxsize)
+        self.base_url = base_url
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+
+class PooledUnixAdapter(UnixAdapter):
+    """
+    UnixAdapter, пул которого держит открытыми до maxsize keep-alive соединений
+    """
+
+    def __init__(self, socket_url, timeout=60, maxsize=1):
+        self.maxsize = maxsize
+        super(PooledUnixAdapter, self).__init__(socket_url, timeout)
+
+    def get_connection(self, url, proxies=None):
+        with self.pools.lock:
+            pool = self.pools.get(url)
+            if pool:
+                return pool
+
+            pool = UnixConnectionPool(url, self.socket_path, self.timeout, self.maxsize)
+            self.pools[url] = pool
+
+        return pool
+
+
+class TaskQueue(Queue):
+    """
+    Очередь задач (runnable, stand, name), которая дополнительно хранит имена ожидающих задач для queues_status
+    """
+
+    def _init(self):
+        super(TaskQueue, self)._init()
+        self.names = deque()
+
+    def _get(self):
+        self.names.popleft()
+        return super(TaskQueue, self)._get()
+
+    def _put(self, item):
+        super(TaskQueue, self)._put(item)
+        self.names.append(item[2])
+
 
 class Engine(object):
-    def __init__(self, domain_name, image, max_active_stands, stop_timeout):
+    def __init__(self, domain_name, image, max_active_stands, stop_timeout, db_addr_cache):
         log.info('Start engine')
         self.domain_name = domain_name
-        self.max_active_stands = max_active_stands
+        self.max_active_stands = int(max_active_stands)
         self.stop_timeout = int(stop_timeout)
+        # Сервер баз контейнера не меняется, пока контейнер не пересоздан. Чтобы не запускать остановленный
+        # контейнер при каждом старте приложения, id контейнера -> сервер баз сохраняется в файл
+        self.db_addr_cache = db_addr_cache
+        self._db_addrs = self._load_db_addrs()
+        # файл пишет один _save_db_addrs за раз, всегда текущее состояние _db_addrs
+        self._db_addrs_dirty = False
+        self._db_addrs_saving = False
+        # id контейнеров из последнего docker ps, записи для остальных удаляются из файла. None - ps еще не было
+        self._container_ids = None
 
-        self.docker = Client(base_url='unix:///var/run/docker.sock')
+        self.docker = Client(base_url=DOCKER_URL)
+        # по соединению на каждый поток пула
+        self.docker.mount('http+docker://', PooledUnixAdapter('http+unix://' + DOCKER_SOCKET, self.docker.timeout,
+                                                              maxsize=DOCKER_WORKERS))
+        # Единственный пул потоков для вызовов докера, им пользуются и движок, и стенды.
+        # Размер совпадает с числом одновременных обновлений в refresh_all
+        self.executor = ThreadPoolExecutor(max_workers=DOCKER_WORKERS)
         self.filter = {"ancestor": image}
         self._stands = {}
+        # стенды, для которых еще не определен сервер баз. В _stands они попадают вместе с очередью
+        self._discovering = {}
         self.queues = {}
+        # кэш результата docker ps: (время запроса по часам IOLoop, номер события докера,
+        # номер события start/die, результат)
+        self._ps_cache = (0.0, 0, 0, None)
+        self._ps_cache_ttl = 1.5
+        self._ps_lock = Lock()
+        # ограничение числа одновременных обновлений стендов в refresh_all
+        self._refresh_semaphore = Semaphore(DOCKER_WORKERS)
+        # выполняющийся refresh_all, к нему присоединяются одновременные вызовы
+        self._refresh_all_future = None
+        # Пока подписка на события докера активна, список стендов меняется только по событиям.
+        # _events_seen - счетчик событий, _events_synced - номер события, после которого список был сверен с docker ps
+        self._events_alive = False
+        self._events_seen = 0
+        self._events_synced = -1
+        # счетчик событий start/die. Запись docker ps, запрошенная до события стенда, старее состояния из события
+        self._state_events_seen = 0
+        self._io_loop = IOLoop.current()
+        # номер версии состояния стендов, меняется при действиях пользователя и событиях докера
+        self.state_version = 0
         self.stands()
+        threading.Thread(target=self._watch_events, name='docker-events', daemon=True).start()
+
+    def _load_db_addrs(self):
+        try:
+            with open(self.db_addr_cache) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning('Cannot read db addr cache %s: %s', self.db_addr_cache, e)
+            return {}
+
+    def _write_db_addrs(self, db_addrs):
+        # выполняется в пуле потоков
+        try:
+            os.makedirs(os.path.dirname(self.db_addr_cache), exist_ok=True)
+            tmp_name = self.db_addr_cache + '.tmp'
+            with open(tmp_name, 'w') as f:
+                json.dump(db_addrs, f)
+            os.replace(tmp_name, self.db_addr_cache)
+        except OSError as e:
+            log.warning('Cannot write db addr cache %s: %s', self.db_addr_cache, e)
+
+    @gen.coroutine
+    def _save_db_addrs(self):
+        """
+        Записывать файл, пока _db_addrs менялся во время записи. Снимок делается в IOLoop перед каждой записью,
+        поэтому более старое состояние не может перезаписать новое
+        """
+        try:
+            while self._db_addrs_dirty:
+                self._db_addrs_dirty = False
+                if self._container_ids is not None:
+                    for container_id in set(self._db_addrs) - self._container_ids:
+                        del self._db_addrs[container_id]
+                yield self.executor.submit(self._write_db_addrs, dict(self._db_addrs))
+        finally:
+            self._db_addrs_saving = False
+
+    def _remember_db_addr(self, container_id, db_addr):
+        if db_addr is None or self._db_addrs.get(container_id) == db_addr:
+            return
+        self._db_addrs[container_id] = db_addr
+        self._db_addrs_dirty = True
+        if not self._db_addrs_saving:
+            self._db_addrs_saving = True
+            IOLoop.current().spawn_callback(self._save_db_addrs)
 
     def queues_status(self):
-        return {name: [v[2] for v in list(q._queue)] for name, q in self.queues.items()}
+        return {name: list(q.names) for name, q in self.queues.items()}
 
     @gen.coroutine
     def _queue_worker(self, queue):
         while True:
-            runnable, lock, name = yield queue.get()
+            runnable, s, name = yield queue.get()
             try:
-                with (yield lock.acquire()):
-                    yield runnable()
+                # очередь сервера баз выполняет по одной задаче на сервер, очередь стенда - по одной операции на стенд
+                yield s.run(runnable)
             except Exception as e:
                 # 400 - ошибки связанные с инфраструктурой и ошибки после обновления тестовых сборок,
                 # т. е. штатные ситуации
@@ -47,6 +196,92 @@ class Engine(object):
             finally:
                 queue.task_done()
 
+    def _watch_events(self):
+        """
+        Выполняется в отдельном потоке: читает поток событий докера и передает их в IOLoop.
+        Для подписки используется отдельный клиент без таймаута, иначе соединение рвется при отсутствии событий
+        """
+        # Фильтр по образу у событий сравнивает образ буквально, а ancestor в docker ps учитывает и
+        # производные образы, поэтому принадлежность контейнера к стендам определяет сверка с docker ps
+        filters = {'type': 'container', 'event': ['create', 'destroy', 'start', 'die']}
+        events_client = Client(base_url=DOCKER_URL, timeout=None)
+        while True:
+            try:
+                stream = events_client.events(filters=filters, decode=True)
+                self._io_loop.add_callback(self._on_events_connected)
+                for event in stream:
+                    self._io_loop.add_callback(self._on_docker_event, event)
+            except Exception as e:
+                log.warning('Docker events stream error: %s', e)
+            self._io_loop.add_callback(self._on_events_lost)
+            time.sleep(5)
+
+    def _on_events_connected(self):
+        log.debug('Subscribed to docker events')
+        self._events_alive = True
+        # события, произошедшие до подписки, неизвестны. Список нужно сверить заново
+        self._events_seen += 1
+
+    def _on_events_lost(self):
+        if self._events_alive:
+            log.warning('Docker events stream is lost. Fall back to docker ps polling')
+        self._events_alive = False
+
+    def _on_docker_event(self, event):
+        action = event.get('Action') or event.get('status')
+        log.debug('Docker event %s %s', action, event.get('id'))
+        if action in ('start', 'die'):
+            # запуск и остановка не меняют список стендов, состояние стенда обновляется без запросов к докеру.
+            # Подписка получает события всех контейнеров хоста, события чужих контейнеров не сбрасывают кэши
+            name = event.get('Actor', {}).get('Attributes', {}).get('name')
+            s = self._stands.get(name) or self._discovering.get(name)
+            if s is not None:
+                self._state_events_seen += 1
+                self.state_version += 1
+                s.apply_docker_event(action, self._state_events_seen)
+            return
+        # создание и удаление: контейнер может оказаться новым стендом, список сверяется с docker ps.
+        # state_version меняет stands(), если список стендов изменился
+        self._events_seen += 1
+        self._io_loop.spawn_callback(self.stands)
+
+    @gen.coroutine
+    def _ps(self):
+        """
+        Список контейнеров из docker ps. Результат кэшируется на _ps_cache_ttl секунд,
+        одновременно в докер уходит не больше одного запроса, остальные ждут его результат.
+        Возвращает номера последних событий докера (изменение списка, start/die) перед запросом и результат,
+        результат None если докер не ответил
+        """
+        with (yield self._ps_lock.acquire()):
+            ts, events_seen, state_events_seen, ps_result = self._ps_cache
+            if ps_result is not None and events_seen == self._events_seen and \
+                    state_events_seen == self._state_events_seen and \
+                    IOLoop.current().time() - ts < self._ps_cache_ttl:
+                return events_seen, state_events_seen, ps_result
+
+            events_seen = self._events_seen
+            state_events_seen = self._state_events_seen
+            # Этот блок обходит баг докера https://github.com/moby/moby/issues/29058
+            # Если докер не ответил за 5 секунд, значит он вероятно занят копированием.
+            # в случае если с последнего вызова изменился список стендов (добавлены, удалены) то эти изменения
+            # не будут показаны пользователю. quiet_exceptions - не логировать это исключение.
+            # Им закончится выполнение футуры когда докер "очнется"
+            try:
+                ps_result = yield gen.with_timeout(datetime.timedelta(seconds=5),
+                                                   self.executor.submit(self.docker.containers, all=True,
+                                                                        filters=self.filter),
+                                                   quiet_exceptions=(ReadTimeout))
+            except gen.TimeoutError:
+                log.debug('Cannot update stand list. Timeout in docker request')
+                return events_seen, state_events_seen, None
+
+            self._ps_cache = (IOLoop.current().time(), events_seen, state_events_seen, ps_result)
+            return events_seen, state_events_seen, ps_result
+
+    def _invalidate_ps_cache(self):
+        self._ps_cache = (0.0,) + self._ps_cache[1:]
+
     @gen.coroutine
     def stands(self):
         """
@@ -54,70 +289,127 @@ class Engine(object):
         Узнает у контейнеров имя базы с которой они работают
         Если контейнер найден в списке впервые то опрашивает его на тему какая база
         """
-        # Этот блок обходит баг докера https://github.com/moby/moby/issues/29058
-        # Если докер не ответил за 5 секунд, значит он вероятно занят копированием.
-        # в случае если с последнего вызова изменился список стендов (добавлены, удалены) то эти изменения
-        # не будут показаны пользователю. quiet_exceptions - не логировать это исключение.
-        # Им закончится выполнение футуры когда докер "очнется"
-        try:
-            ps_result = yield gen.with_timeout(datetime.timedelta(seconds=5),
-                                               Stand.TPE.submit(self.docker.containers, all=True, filters=self.filter),
-                                               quiet_exceptions=(ReadTimeout))
-        except gen.TimeoutError:
-            log.debug('Cannot update stand list. Timeout in docker request')
+        # список уже сверен с docker ps и с тех пор контейнеры не создавались и не удалялись
+        if self._events_alive and self._events_synced == self._events_seen:
+            return self._stands
+
+        events_seen, _, ps_result = yield self._ps()
+        if ps_result is None:
             return self._stands
 
         # отсекаю слеш в начале имени
-        name_list = [record['Names'][0][1:] for record in ps_result]
+        ids = {record['Names'][0][1:]: record['Id'] for record in ps_result}
+        self._container_ids = set(ids.values())
+        name_list = list(ids)
 
         # удаляю информацию о контейнерах которые перестали существовать
         for current_name in list(self._stands):
             if current_name not in name_list:
-                del self._stands[current_name]
+                self._stands.pop(current_name).close()
+                self.state_version += 1
 
         for name in name_list:
-            if name in self._stands:
-                continue
+            if name not in self._stands and name not in self._discovering:
+                yield self._add_stand(name, ids[name])
 
-            s = Stand(name=name,
-                      test_tools_addr=self.domain_name,
-                      stop_timeout=self.stop_timeout)
+        self._events_synced = max(self._events_synced, events_seen)
+        return self._stands
+
+    @gen.coroutine
+    def _add_stand(self, name, container_id):
+        s = Stand(name=name,
+                  docker_client=self.docker,
+                  executor=self.executor,
+                  test_tools_addr=self.domain_name,
+                  stop_timeout=self.stop_timeout)
+        self._discovering[name] = s
+        events_seen = self._events_seen
+        discovered = False
+        try:
+            yield s.run(functools.partial(self._discover, s, container_id))
+            discovered = True
+        finally:
+            # стенд, который не удалось опросить, все равно показывается пользователю, но без очереди
+            del self._discovering[name]
             self._stands[name] = s
-            with (yield s.lock.acquire()):
-                # Если стенд не запущен, то нужно его запустить чтобы опросить на тему, какой сервер баз он использует
-                yield s.refresh()
-                if not s.running:
-                    yield s.start()
-                    yield s.stop()
-
-                try:
-                    # если уже есть очередь для этого сервера баз данных, то "записываем" стенд в эту очередь
-                    s.queue = self.queues[s.db_addr]
-                except KeyError:
-                    # если очереди нет, создаем новую
-                    q = Queue(maxsize=100)
-                    s.queue = q
-                    IOLoop.current().spawn_callback(self._queue_worker, q)
-                    self.queues[s.db_addr] = q
+            self.state_version += 1
+            # Пока стенд опрашивался, контейнер могли удалить: сверка списка в это время его не видела.
+            # Следующий stands() сверит список с docker ps заново
+            if not discovered or self._events_seen != events_seen:
+                self._events_seen += 1
 
-        return self._stands
+    @gen.coroutine
+    def _discover(self, s, container_id):
+        # Если стенд не запущен и его сервер баз неизвестен, то нужно его запустить чтобы опросить на тему,
+        # какой сервер баз он использует
+        yield s.refresh()
+        if not s.running:
+            s.db_addr = self._db_addrs.get(container_id)
+            if s.db_addr is None:
+                yield s.start()
+                yield s.refresh_status()
+                yield s.stop()
+        self._remember_db_addr(container_id, s.db_addr)
+
+        try:
+            # если уже есть очередь для этого сервера баз данных, то "записываем" стенд в эту очередь
+            s.queue = self.queues[s.db_addr]
+        except KeyError:
+            # если очереди нет, создаем новую
+            q = TaskQueue(maxsize=100)
+            s.queue = q
+            IOLoop.current().spawn_callback(self._queue_worker, q)
+            self.queues[s.db_addr] = q
 
     @gen.coroutine
     def refresh_all(self):
+        """
+        Обновить состояние всех стендов. Одновременные вызовы (несколько браузеров, запуск стенда)
+        дожидаются одного обновления
+        """
+        future = self._refresh_all_future
+        if future is None:
+            future = self._refresh_all_future = self._refresh_all()
+        try:
+            ss = yield future
+        finally:
+            if self._refresh_all_future is future:
+                self._refresh_all_future = None
+        return ss
+
+    @gen.coroutine
+    def _refresh_all(self):
         ss = yield self.stands()
-        yield gen.multi([s.refresh() for s in ss.values()])
+        # состояние и порты всех контейнеров есть в одном docker ps, inspect по каждому стенду не нужен
+        _, state_events_seen, ps_result = yield self._ps()
+        records = {record['Names'][0][1:]: record for record in ps_result or ()}
+        futures = []
+        for name, s in ss.items():
+            # после запроса ps пришло событие start/die стенда: запись устарела, состояние читается через inspect
+            if name in records and s.state_event <= state_events_seen:
+                s.apply_ps_record(records[name])
+                futures.append(self._limited(s.refresh_status))
+            else:
+                futures.append(self._limited(s.refresh))
+        yield gen.multi(futures)
         return ss
 
+    @gen.coroutine
+    def _limited(self, method):
+        with (yield self._refresh_semaphore.acquire()):
+            yield method()
+
     @gen.coroutine
     def _free_resources(self):
         """
         Можно ли запустить еще один стенд
         """
-        c = 0
-        ss = yield self.refresh_all()
-        for s in ss.values():
-            if s.running and s.tomcat_returncode is None:
-                c += 1
+        if self._events_alive:
+            # состояние контейнеров поддерживается по событиям докера, а состояние tomcat - по запуску и остановке
+            ss = yield self.stands()
+        else:
+            ss = yield self.refresh_all()
+        c = sum(1 for s in ss.values() if s.running and s.tomcat_returncode is None)
         if c >= self.max_active_stands:
             raise RuntimeError('No resources')
 
@@ -135,7 +427,7 @@ class Engine(object):
     def log(self, name, tail):
         """
         Получить логи стенда
-        :param tail: колличество строк с конца
+        :param tail: колличество строк с конца (int) или 'all'
         """
 
         s = yield self._stand_with_validate(name)
@@ -148,8 +440,9 @@ class Engine(object):
 ё       Остановить стенд
         """
         s = yield self._stand_with_validate(name)
-        with (yield s.lock.acquire()):
-            yield s.stop()
+        yield s.run(s.stop)
+        self._invalidate_ps_cache()
+        self.state_version += 1
         return 'Done'
 
     @gen.coroutine
@@ -157,12 +450,23 @@ class Engine(object):
         """
         Запустить стенд
         """
-        self._free_resources()
+        yield self._free_resources()
         s = yield self._stand_with_validate(name)
-        with (yield s.lock.acquire()):
-            yield s.start()
+        yield s.run(s.start)
+        self._invalidate_ps_cache()
+        self.state_version += 1
         return 'Done'
 
+    def _enqueue(self, s, runnable, task_name):
+        if s.queue is None:
+            log.warning('Stand %s has no task queue. Skip task %s', s.name, task_name)
+            return
+        self.state_version += 1
+        log.info('New task: %s, stand: %s', task_name, s.name)
+        # Очередь безопасна для нескольких производителей, а саму задачу воркер очереди
+        # передает в очередь стенда
+        s.queue.put((runnable, s, '{} {}'.format(task_name, s.name)))
+
     @gen.coroutine
     def backup_all(self):
         """
@@ -172,9 +476,7 @@ class Engine(object):
         ss = yield self.stands()
         for s in ss.values():
             assert isinstance(s, Stand)
-            log.info('New task: backup, stand: %s', s.name)
-            with(yield s.lock.acquire()):
-                s.queue.put((s.backup, s.lock, 'backup {}'.format(s.name)))
+            self._enqueue(s, s.backup, 'backup')
 
     @gen.coroutine
     def update_all(self):
@@ -185,10 +487,7 @@ class Engine(object):
         ss = yield self.stands()
         for s in ss.values():
             assert isinstance(s, Stand)
-            log.info('New task: update, stand: %s', s.name)
-            # возможно в этот момент для стенда создется очередь
-            with(yield s.lock.acquire()):
-                s.queue.put((s.update, s.lock, 'update {}'.format(s.name)))
+            self._enqueue(s, s.update, 'update')
 
     @gen.coroutine
     def backup_and_update(self):
@@ -199,7 +498,4 @@ class Engine(object):
         ss = yield self.stands()
         for s in ss.values():
             assert isinstance(s, Stand)
-
-            log.info('New task: backup and update, stand: %s', s.name)
-            with(yield s.lock.acquire()):
-                s.queue.put((s.backup_and_update, s.lock, 'backup_and_update {}'.format(s.name)))
+            self._enqueue(s, s.backup_and_update, 'backup_and_update')
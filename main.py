@@ -4,12 +4,15 @@ import logging
 import logging.config
 import os
 
+from tornado.httpclient import AsyncHTTPClient
 from tornado.ioloop import IOLoop
 from tornado.web import Application
 
 import web_handlers
 from engine import Engine
 
+HTTP_MAX_CLIENTS = 50
+
 
 def default_logging(log_level):
     int_level = logging._nameToLevel[log_level]
@@ -34,6 +37,22 @@ def default_logging(log_level):
     }
 
 
+def configure_http_client():
+    """
+    Клиент на libcurl держит keep-alive соединения с test tools, если pycurl не установлен
+    используется стандартный клиент торнадо.
+    Запросы бэкапа и обновления с sync=1 занимают соединение на часы, поэтому лимит одновременных
+    запросов поднят, чтобы они не блокировали короткие запросы engine_status
+    """
+    try:
+        import pycurl  # noqa: F401
+    except ImportError:
+        logging.getLogger(__name__).warning('pycurl is not installed, use simple http client')
+        AsyncHTTPClient.configure(None, max_clients=HTTP_MAX_CLIENTS)
+        return
+    AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient', max_clients=HTTP_MAX_CLIENTS)
+
+
 def main():
     application = Application([
         (r'/', web_handlers.MainPageHandler),
@@ -48,6 +67,7 @@ def main():
         'image': 'tandemservice/test-tools',
         'max_active_stands': 6,
         'stop_timeout': '480',
+        'db_addr_cache': '/var/lib/test_tools_group/db_addrs.json',
         'log_level': 'INFO'
     }
 
@@ -60,6 +80,9 @@ def main():
                            'Usually ip of eth0 is correct')
 
     logging.config.dictConfig(default_logging(params.pop('log_level')))
+    configure_http_client()
+    # Engine при создании сразу запрашивает docker ps и подписывается на события докера: модули docker-py,
+    # соединения с docker.sock и потоки пула готовы до первого запроса к приложению
     application.engine = Engine(**params)
 
     application.listen(8888)
@@ -1,54 +1,191 @@
 import json
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import random
+import sys
+from collections import deque
 
-from docker import Client
-from tornado import gen, locks
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue
+
+try:
+    # ujson быстрее стандартного json и принимает bytes без промежуточного декодирования
+    from ujson import loads as json_loads
+except ImportError:
+    def json_loads(data):
+        return json.loads(data.decode('utf8'))
 
 log = logging.getLogger(__name__)
 
 
 class Stand(object):
-    TPE = ThreadPoolExecutor(max_workers=4)
+    # сколько секунд ждать, пока test tools в контейнере начнет отвечать
+    CONNECT_TIMEOUT = 15
+    # сколько последних строк лога отдавать при tail=all
+    LOG_MAX_LINES = 50000
+    # размер блока, которым разбирается поток лога
+    LOG_READ_BLOCK = 64 * 1024
 
-    def __init__(self, name, test_tools_addr, stop_timeout):
-        # параметр для управления контейнером
+    def __init__(self, name, docker_client, executor, test_tools_addr, stop_timeout):
+        # параметры для управления контейнером
         self.name = name
+        # общий для всех стендов клиент докера, его сессия requests держит соединения с docker.sock
+        self.docker = docker_client
+        # общий пул потоков для блокирующих вызовов docker_client
+        self.executor = executor
         # параметры для коммуникации с test-tools внутри контейнера
         self.test_tools_addr = test_tools_addr
         self.test_tools_port = None
         self.uni_port = None
+        # момент запуска контейнера, для которого прочитаны порты
+        self._ports_started_at = None
+        # Config.Tty контейнера, не меняется за время его жизни. None - еще не известен
+        self._tty = None
 
         # динамические параметры этого приложения
         self.queue = None
-        self.docker = Client(base_url='unix:///var/run/docker.sock')
-        self.stop_future = None
+        # таймер выключения стенда по таймауту (tornado timeout handle)
+        self._stop_timer = None
         self.stop_timeout = stop_timeout
-        self.lock = locks.Lock()
+        # Операции, меняющие состояние стенда, выполняются по одной воркером стенда, блокировка не нужна
+        self._tasks = Queue()
+        # после close() стенда уже нет, новые операции сразу завершаются ошибкой
+        self._closed = False
+        IOLoop.current().spawn_callback(self._task_worker)
+        # выполняющиеся обновления: имя метода -> футура
+        self._inflight = {}
 
         # обновляемые параметры
         self.db_addr = None
         self.running = None
+        # номер последнего события start/die этого контейнера, см. Engine._state_events_seen
+        self.state_event = 0
         self.tomcat_returncode = None
         self.last_task = None
         self.last_error = None
         self.active_task = None
         self.uni_version = None
 
+    def run(self, method):
+        """
+        Поставить операцию со стендом в очередь стенда
+        :param method: функция без аргументов, возвращающая футуру
+        :return: Future с результатом операции
+        """
+        future = Future()
+        if self._closed:
+            future.set_exception(self._removed_error())
+        else:
+            self._tasks.put_nowait((method, future))
+        return future
+
+    def close(self):
+        """
+        Остановить воркер стенда после уже поставленных операций
+        """
+        self._closed = True
+        self._cancel_stop_timer()
+        self._tasks.put_nowait(None)
+
+    def _removed_error(self):
+        return RuntimeError('Stand %s is removed' % self.name)
+
+    @gen.coroutine
+    def _task_worker(self):
+        while True:
+            task = yield self._tasks.get()
+            if task is None:
+                break
+            method, future = task
+            try:
+                result = yield method()
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+        # операции, не успевшие выполниться до close(), не должны ждать вечно
+        while self._tasks.qsize():
+            task = self._tasks.get_nowait()
+            if task is not None:
+                task[1].set_exception(self._removed_error())
+
     @gen.coroutine
+    def _single_flight(self, method):
+        """
+        Одновременные вызовы не дублируют запросы к докеру и test tools,
+        а дожидаются уже выполняющегося вызова
+        """
+        future = self._inflight.get(method)
+        if future is None:
+            future = self._inflight[method] = method()
+        try:
+            yield future
+        finally:
+            if self._inflight.get(method) is future:
+                del self._inflight[method]
+
     def refresh(self):
-        c_inspect = yield self.TPE.submit(self.docker.inspect_container, self.name)
-        self.running = c_inspect['State']['Running']
+        """
+        Обновить состояние контейнера и параметры test tools
+        """
+        return self._single_flight(self._refresh)
+
+    def refresh_status(self):
+        """
+        Обновить параметры test tools. Состояние контейнера должно быть уже известно, например из apply_ps_record
+        """
+        return self._single_flight(self._refresh_status)
+
+    def apply_ps_record(self, record):
+        """
+        Обновить состояние контейнера по записи из docker ps, не запрашивая inspect
+        """
+        self.running = record['State'] == 'running'
+        # в записи ps нет времени запуска, при следующем inspect порты нужно прочитать заново
+        self._ports_started_at = None
         if self.running:
-            try:
-                self.test_tools_port = c_inspect['NetworkSettings']['Ports']['8082/tcp'][0]['HostPort']
-                self.uni_port = c_inspect['NetworkSettings']['Ports']['8080/tcp'][0]['HostPort']
-            except (KeyError, IndexError, TypeError):
+            ports = {(p['PrivatePort'], p['Type']): p.get('PublicPort') for p in record['Ports']}
+            self.test_tools_port = ports.get((8082, 'tcp'))
+            self.uni_port = ports.get((8080, 'tcp'))
+            if self.test_tools_port is None or self.uni_port is None:
                 logging.warning('Found container name=%s with unbind ports. Cannot use it', self.name)
+                self.test_tools_port = None
+
+    @gen.coroutine
+    def _refresh(self):
+        yield self._inspect()
+        yield self._refresh_status()
+
+    @gen.coroutine
+    def _inspect(self):
+        """
+        Обновить состояние контейнера и его порты по docker inspect
+        """
+        c_inspect = yield self.executor.submit(self.docker.inspect_container, self.name)
+        self.running = c_inspect['State']['Running']
+        if self.running:
+            # порты меняются только при перезапуске контейнера
+            started_at = c_inspect['State']['StartedAt']
+            if started_at != self._ports_started_at:
+                try:
+                    self.test_tools_port = c_inspect['NetworkSettings']['Ports']['8082/tcp'][0]['HostPort']
+                    self.uni_port = c_inspect['NetworkSettings']['Ports']['8080/tcp'][0]['HostPort']
+                except (KeyError, IndexError, TypeError):
+                    logging.warning('Found container name=%s with unbind ports. Cannot use it', self.name)
+                    self.test_tools_port = None
+                    self._ports_started_at = None
+                    return
+                self._ports_started_at = started_at
+
+    @gen.coroutine
+    def _refresh_status(self):
+        if self.running:
+            if self.test_tools_port is None:
                 return
             response = yield self._test_tool_action('engine_status', 10)
-            engine_status = json.loads(response.body.decode('utf8'))
+            engine_status = json_loads(response.body)
             self.db_addr = engine_status['db_addr']
             self.tomcat_returncode = engine_status['tomcat_returncode']
             self.last_task = engine_status['last_task']
@@ -56,36 +193,59 @@ class Stand(object):
             self.active_task = engine_status['active_task']
             self.uni_version = engine_status['uni_version']
         else:
-            self.tomcat_returncode = '-'
-            self.last_task = '-'
-            self.last_error = '-'
-            self.active_task = '-'
-            self.uni_version = '-'
+            self._set_stopped_status()
+
+    def _set_stopped_status(self):
+        self.tomcat_returncode = '-'
+        self.last_task = '-'
+        self.last_error = '-'
+        self.active_task = '-'
+        self.uni_version = '-'
+
+    def apply_docker_event(self, action, number):
+        """
+        Обновить состояние контейнера по событию докера start или die без запросов к докеру
+        :param number: номер события start/die в Engine
+        """
+        self.state_event = number
+        if action == 'start':
+            self.running = True
+            self._ports_started_at = None
+        elif action == 'die':
+            self.running = False
+            self._set_stopped_status()
 
     @gen.coroutine
     def _test_tool_action(self, action_name, timeout):
         http_request = 'http://{}:{}/{}?sync=1'.format(self.test_tools_addr, self.test_tools_port, action_name)
         log.debug('Request %s timeout=%s', http_request, timeout)
-        cl = AsyncHTTPClient()
-        # сразу после запуска контейнера test tools недоступен, Пытаемся соедениться примерно 15 секунд
+        # сразу после запуска контейнера test tools недоступен, Пытаемся соедениться примерно 15 секунд.
+        # Пауза между попытками растет от 50 мс до секунды: обычно test tools отвечает почти сразу.
+        # Срок отсчитывается от первой неудачной попытки, на успешном первом запросе лишней работы нет
+        deadline = None
         try_count = 0
-        while try_count < 15:
+        while True:
             try:
-                response = yield cl.fetch(http_request, request_timeout=timeout)
+                # AsyncHTTPClient() - общий для IOLoop экземпляр, см. main.configure_http_client
+                response = yield AsyncHTTPClient().fetch(http_request, request_timeout=timeout)
                 # если порт уже прослушивается но сервер не готов отвечать на запросы то вернется пустой ответ
                 if response:
                     return response
             # вместо ConnectionError торнадо клиент иногда кидает HTTPError с кодом 599
-            except ConnectionError:
-                pass
-            except HTTPError as e:
-                if not e.code == 599:
-                    raise e
-            yield gen.sleep(1)
+            except (ConnectionError, HTTPError) as e:
+                if isinstance(e, HTTPError) and e.code != 599:
+                    raise
+            now = IOLoop.current().time()
+            if deadline is None:
+                deadline = now + self.CONNECT_TIMEOUT
+            elif now >= deadline:
+                break
+            yield gen.sleep(min(0.05 * 2 ** try_count, 1.0) + random.random() * 0.05)
             try_count += 1
         # Если подключиться не удалось то возоможно кто-то остановил контейнер, но что поделать, значит нельзя
         # закончить текущую операцию
-        self.running = yield self.TPE.submit(self.docker.inspect_container, self.name)['State']['Running']
+        c_inspect = yield self.executor.submit(self.docker.inspect_container, self.name)
+        self.running = c_inspect['State']['Running']
         if not self.running:
             raise RuntimeError('Container %s has stopped unexpectedly' % self.name)
         else:
@@ -95,7 +255,8 @@ class Stand(object):
     def backup(self):
         log.info('Backup %s started', self.name)
         yield self.start()
-        yield self.refresh()
+        # как и в start, к обновлению с состоянием до запуска не присоединяемся
+        yield self._refresh_status()
         # ждем запуска uni чтобы не забэкапить сломанный стенд
         yield self._test_tool_action('check_uni', 1000)
         yield self._test_tool_action('backup', 10800)
@@ -116,48 +277,96 @@ class Stand(object):
         yield self.backup()
         yield self.update()
 
-    @gen.coroutine
     def log(self, tail=150):
         """
         Получить логи стенда
-        :param tail: колличество строк с конца
-        :return: str
+        :param tail: колличество строк с конца (int) или 'all'
+        :return: Future с bytes
         """
         log.debug('Read log file for stand %s', self.name)
-        if tail != 'all':
-            try:
-                tail = int(tail)
-            except ValueError:
-                tail = 150
-        log_str = yield self.TPE.submit(self.docker.logs, self.name, tail=tail)
-        return log_str
+        return self.executor.submit(self._read_log, tail)
+
+    def _read_log(self, tail):
+        """
+        Выполняется в пуле потоков. Лог читается блоками, в памяти остается не больше LOG_MAX_LINES строк.
+        Исключение - контейнеры с tty: их лог приходит одним ответом целиком, при tail=all это весь лог
+        """
+        if self._tty is None:
+            self._tty = self.docker.inspect_container(self.name)['Config']['Tty']
+        if self._tty:
+            # для контейнеров с tty docker-py отдает поток по одному символу. Лог читается одним ответом,
+            # его размер ограничивает tail
+            blocks = [self.docker.logs(self.name, stream=False, tail=tail)]
+        else:
+            blocks = self._log_blocks(tail)
+        lines = deque(maxlen=self.LOG_MAX_LINES)
+        rest = b''
+        for block in blocks:
+            block_lines = (rest + block).split(b'\n')
+            rest = block_lines.pop()
+            lines.extend(block_lines)
+        if not lines:
+            return rest
+        return b'\n'.join(lines) + b'\n' + rest
+
+    def _log_blocks(self, tail):
+        """
+        Фреймы потока лога (обычно по строке) склеиваются в блоки не меньше LOG_READ_BLOCK байт
+        """
+        chunks = []
+        size = 0
+        for chunk in self.docker.logs(self.name, stream=True, follow=False, tail=tail):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= self.LOG_READ_BLOCK:
+                yield b''.join(chunks)
+                chunks = []
+                size = 0
+        if chunks:
+            yield b''.join(chunks)
+
+    def _set_stop_timer(self):
+        self._cancel_stop_timer()
+        if self.stop_timeout:
+            self._stop_timer = IOLoop.current().call_later(self.stop_timeout * 60, self._on_stop_timer)
+
+    def _cancel_stop_timer(self):
+        if self._stop_timer is not None:
+            IOLoop.current().remove_timeout(self._stop_timer)
+            self._stop_timer = None
+
+    def _on_stop_timer(self):
+        self._stop_timer = None
+        # f.result() пробросит исключение остановки, и IOLoop его залогирует
+        IOLoop.current().add_future(self.run(self.stop_by_timeout), lambda f: f.result())
 
     @gen.coroutine
-    def stop_by_timeout(self, future):
-        # Tornado ``Futures`` do not support cancellation at current version
-        # if name in sm.stands_futures:
-        #     sm.stands_futures[name].cancel()
-        # Торнадовская футура передаст self в callback
-        if future is self.stop_future:
-            log.info('Stop by timeout %s', self.name)
-            with (yield self.lock.acquire()):
-                yield self.stop()
+    def stop_by_timeout(self):
+        # пока операция ждала в очереди, стенд могли перезапустить с новым таймером
+        if self._stop_timer is not None:
+            return
+        log.info('Stop by timeout %s', self.name)
+        yield self.stop()
 
     @gen.coroutine
     def start(self):
         log.info('Start stand %s', self.name)
         # Выключение стенда по таймауту
-        if self.stop_timeout:
-            future = gen.sleep(self.stop_timeout * 60)
-            future.add_done_callback(self.stop_by_timeout)
-            self.stop_future = future
+        self._set_stop_timer()
 
-        yield self.TPE.submit(self.docker.start, self.name)
-        yield self.refresh()
+        yield self.executor.submit(self.docker.start, self.name)
+        # Нужны только порты test tools. engine_status до start_tomcat не запрашивается, он сразу устареет
+        # уже выполняющееся обновление могло прочитать состояние до запуска контейнера, к нему не присоединяемся
+        yield self._inspect()
         yield self._test_tool_action('start_tomcat', 30)
+        # tomcat запущен, код возврата появится только после его остановки
+        self.tomcat_returncode = None
 
     @gen.coroutine
     def stop(self):
         log.info('Stop stand %s', self.name)
-        self.stop_future = None
+        self._cancel_stop_timer()
         yield self._test_tool_action('stop_tomcat', 60)
+        # код возврата остановленного tomcat нужен для подсчета запущенных стендов.
+        # Уже выполняющееся обновление могло прочитать статус до остановки, к нему не присоединяемся
+        yield self._refresh_status()
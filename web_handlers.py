@@ -1,73 +1,139 @@
 import logging
 import os
+from html import escape
+from string import Formatter
 
-from tornado import gen
+from tornado import gen, locks
+from tornado.httpclient import HTTPError
+from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler
 
-from stand import Stand
-
 log = logging.getLogger('engine')
 
 
-class MainPageHandler(RequestHandler):
-    with open(os.path.join(os.path.dirname(__file__), 'html', 'main_page.html')) as f:
-        PAGE_TEMPLATE = f.read()
+# 143 application was terminated due to a SIGTERM command (стандартная остановка процесса)
+# 137 Script terminated by kill signal (например неожиданно убит докер полным выключением питания)
+# -15 A negative value -N indicates that the child was terminated by signal N (POSIX only).
+# None - процесс еще работает. Остальные коды - ошибка, например 1
+TOMCAT_STATUS = {
+    0: 'Остановлен (корректно)',
+    143: 'Остановлен (корректно)',
+    -15: 'Остановлен (корректно)',
+    137: 'Остановлен (принудительно)',
+    None: 'Работает',
+}
+
+
+_HTML_DIR = os.path.join(os.path.dirname(__file__), 'html')
+
+
+def _load(name):
+    with open(os.path.join(_HTML_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def _split(name, placeholder=b'{content}'):
+    """
+    Шаблон с единственным полем: (bytes до поля, bytes после поля)
+    """
+    prefix, suffix = _load(name).split(placeholder, 1)
+    return prefix, suffix
+
+
+def compile_template(template):
+    """
+    Собрать из шаблона с полями {name} функцию render(*, name, ...) -> str.
+    Шаблон разбирается один раз, функция склеивает готовые куски текста и значения полей
+    """
+    fields, parts = [], []
+    for literal, field, format_spec, conversion in Formatter().parse(template):
+        if literal:
+            parts.append(repr(literal))
+        if field is not None:
+            # render склеивает str(значение), {x!r} и {x:>5} он бы молча отрисовал иначе, чем str.format
+            if format_spec or conversion:
+                raise ValueError('Conversion and format spec are not supported in template field {%s}' % field)
+            if field not in fields:
+                fields.append(field)
+            parts.append('str({})'.format(field))
+    source = 'def render(*, {}):\n    return \'\'.join(({},))\n'.format(', '.join(fields), ', '.join(parts))
+    namespace = {}
+    exec(source, namespace)
+    return namespace['render']
+
+
+# Шаблоны читаются один раз при импорте. Постоянные части страниц хранятся уже закодированными в utf-8
+PAGE_PREFIX, PAGE_SUFFIX = _split('main_page.html')
+render_stand = compile_template(_load('stand.html').decode('utf8'))
+LOG_PREFIX, LOG_SUFFIX = _split('log.html')
+ADMIN_HTML = _load('admin_page.html')
 
-    with open(os.path.join(os.path.dirname(__file__), 'html', 'stand.html')) as f:
-        CONTENT_TEMPLATE = f.read()
+
+class MainPageHandler(RequestHandler):
+    # Страницу опрашивают несколько браузеров сразу. Готовая страница (время, версия состояния движка, bytes)
+    # отдается повторно в течение CACHE_TTL секунд, пока версия состояния не изменилась
+    CACHE_TTL = 0.5
+    _cache = (0.0, None, None)
+    _cache_lock = locks.Lock()
+
+    @classmethod
+    def _cached_page(cls, engine):
+        ts, version, page = cls._cache
+        if version == engine.state_version and IOLoop.current().time() - ts < cls.CACHE_TTL:
+            return page
+        return None
 
     @gen.coroutine
     def get(self):
-        content = ''
         engine = self.application.engine
+        page = self._cached_page(engine)
+        if page is None:
+            # одновременные запросы ждут одну отрисовку
+            with (yield self._cache_lock.acquire()):
+                page = self._cached_page(engine)
+                if page is None:
+                    version = engine.state_version
+                    page = yield self._render(engine)
+                    MainPageHandler._cache = (IOLoop.current().time(), version, page)
+        self.finish(page)
 
+    @gen.coroutine
+    def _render(self, engine):
+        parts = []
         ss = yield engine.refresh_all()
-        names = list(ss.keys())
-        names.sort()
-
-        for name in names:
-            s = ss[name]
-            # ss.values() возвращает не в алфавитном порядке
-            assert isinstance(s, Stand)
-            # 143 application was terminated due to a SIGTERM command (стандартная остановка процесса)
-            # 137 Script terminated by kill signal (например неожиданно убит докер полным выключением питания)
-            # -15 A negative value -N indicates that the child was terminated by signal N (POSIX only).
-            # 1 error
+        domain_name = engine.domain_name
+        # ss.values() возвращает не в алфавитном порядке
+        for name, s in sorted(ss.items()):
             if not s.running:
                 tomcat_status = '-'
-            elif s.tomcat_returncode in (0, 143, -15):
-                tomcat_status = 'Остановлен (корректно)'
-            elif s.tomcat_returncode == 137:
-                tomcat_status = 'Остановлен (принудительно)'
-            elif s.tomcat_returncode is None:
-                tomcat_status = 'Работает'
             else:
-                tomcat_status = 'Ошибка (returncode {})'.format(s.tomcat_returncode)
-            content += self.CONTENT_TEMPLATE.format(name=s.name,
-                                                    container_status='запущен' if s.running else 'остановлен',
-                                                    tomcat_status=tomcat_status,
-                                                    active_task=s.active_task or 'нет',
-                                                    last_task=s.last_task or 'нет',
-                                                    last_error=s.last_error or 'нет',
-                                                    domain_name=engine.domain_name,
-                                                    test_tools_port=s.test_tools_port,
-                                                    uni_version=s.uni_version,
-                                                    uni_port=s.uni_port)
-        self.finish(self.PAGE_TEMPLATE.format(content=content or 'Стенды не найдены'))
+                tomcat_status = TOMCAT_STATUS.get(s.tomcat_returncode) or \
+                                'Ошибка (returncode {})'.format(escape(str(s.tomcat_returncode)))
+            parts.append(render_stand(name=s.name,
+                                      container_status='запущен' if s.running else 'остановлен',
+                                      tomcat_status=tomcat_status,
+                                      # задачи и ошибки приходят из test tools как есть
+                                      active_task=escape(str(s.active_task or 'нет')),
+                                      last_task=escape(str(s.last_task or 'нет')),
+                                      last_error=escape(str(s.last_error or 'нет')),
+                                      domain_name=domain_name,
+                                      test_tools_port=s.test_tools_port,
+                                      uni_version=escape(str(s.uni_version)),
+                                      uni_port=s.uni_port))
+        return b''.join((PAGE_PREFIX, (''.join(parts) or 'Стенды не найдены').encode('utf8'), PAGE_SUFFIX))
 
 
 class MassActionHandler(RequestHandler):
-    ACTIONS = ('update_all', 'backup_all', 'backup_and_update')
+    ACTIONS = frozenset(('update_all', 'backup_all', 'backup_and_update'))
     QUEUES_STATUS = 'queues_status'
 
     @gen.coroutine
     def get(self, action):
         engine = self.application.engine
         if action in self.ACTIONS:
-            for q in engine.queues.values():
-                if not q.empty():
-                    self.finish('Busy with another mass task')
-                    return
+            if any(not q.empty() for q in engine.queues.values()):
+                self.finish('Busy with another mass task')
+                return
 
             output = yield getattr(engine, action)()
             self.finish(output)
@@ -82,20 +148,35 @@ class MassActionHandler(RequestHandler):
 
 
 class ContainerActions(RequestHandler):
-    ACTIONS = ('start', 'stop')
+    ACTIONS = frozenset(('start', 'stop'))
     LOG = 'log'
-
-    with open(os.path.join(os.path.dirname(__file__), 'html', 'log.html')) as f:
-        LOG_TEMPLATE = f.read()
+    # ожидаемые ошибки действий: нет ресурсов/стенда, test tools не отвечает, ошибки docker (OSError).
+    # Остальное - ошибка программы, ее отдаст торнадо как 500
+    ERRORS = (RuntimeError, ValueError, OSError, HTTPError)
+    ERROR_MAX_LENGTH = 512
+    # допустимое число строк в tail, кроме tail=all (его ограничивает Stand.LOG_MAX_LINES)
+    LOG_TAIL_MAX = 10000
+
+    def _tail(self):
+        tail = self.get_argument('tail', '150')
+        if tail == 'all':
+            return tail
+        try:
+            tail = int(tail)
+        except ValueError:
+            raise ValueError('tail must be a number or all')
+        return min(max(tail, 1), self.LOG_TAIL_MAX)
 
     @gen.coroutine
     def get(self, name, action):
         engine = self.application.engine
         try:
             if action == self.LOG:
-                tail = self.get_argument('tail', '150')
-                output = yield engine.log(name=name, tail=tail)
-                self.finish(self.LOG_TEMPLATE.format(content=output.decode()))
+                output = yield engine.log(name=name, tail=self._tail())
+                # лог отдается как есть, без decode/encode
+                self.write(LOG_PREFIX)
+                self.write(output)
+                self.finish(LOG_SUFFIX)
                 return
 
             if action in self.ACTIONS:
@@ -103,9 +184,10 @@ class ContainerActions(RequestHandler):
                 self.finish(output)
                 return
 
-        except Exception as e:
+        except self.ERRORS as e:
+            log.warning('Action %s for stand %s failed: %s', action, name, e)
             self.set_status(400)
-            self.finish(str(e))
+            self.finish(str(e)[:self.ERROR_MAX_LENGTH])
             return
 
         self.set_status(404, 'invalid action')
@@ -113,8 +195,5 @@ class ContainerActions(RequestHandler):
 
 
 class AdminPageHandler(RequestHandler):
-    with open(os.path.join(os.path.dirname(__file__), 'html', 'admin_page.html')) as f:
-        HTML_TEMPLATE = f.read()
-
     def get(self):
-        self.finish(self.HTML_TEMPLATE)
+        self.finish(ADMIN_HTML)